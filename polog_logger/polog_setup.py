@@ -1,11 +1,84 @@
+import atexit
 import json
 import logging
-
-from typing import Callable
-from pydantic import BaseModel, validate_model, ValidationError
+import os
+import threading
+import weakref
+
+from collections import deque
+from typing import Any, Callable, Dict, ForwardRef, List, Literal, Optional
+from typing import Sequence, Tuple, Type
+from typing import get_args, get_origin
+from pydantic import BaseModel, Extra, ValidationError
+from pydantic.schema import get_flat_models_from_model, get_model_name_map
 from polog import config, file_writer
 from polog.core.log_item import LogItem
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Errors raised by the validators of `getLogModelValidator` for logs that don't
+# conform to the model. msgspec errors are not `ValueError`s before msgspec 0.19
+VALIDATION_ERRORS: Tuple[Type[Exception], ...] = (ValueError, ValidationError)
+if msgspec is not None:
+    VALIDATION_ERRORS += (msgspec.DecodeError,)
+
+# Names of the standard logging levels, to avoid looking them up on every log
+_LEVEL_NAMES: Dict[int, str] = {
+    level: logging.getLevelName(level)
+    for level in (
+        logging.DEBUG,
+        logging.INFO,
+        logging.WARNING,
+        logging.ERROR,
+        logging.CRITICAL,
+    )
+}
+
+# Formatters already generated for a given sequence of log fields
+_FORMAT_CACHE: Dict[Tuple[str, ...], Callable[[LogItem], str]] = {}
+
+# Names under which our handlers are registered in polog, so that they can be
+# replaced when logging is set up again
+_CONSOLE_HANDLER_NAME = "polog_logger_console"
+_FILE_HANDLER_NAME = "polog_logger_file"
+
+# Arguments of the last `setup_logging` call
+_CURRENT_SETUP: Optional[Tuple[Any, ...]] = None
+
+# Size of the write buffer of the log file. Log lines are accumulated here and
+# written to disk in a single syscall
+_FILE_BUFFER_SIZE = 64 * 1024
+
+# Maximum number of log lines joined into a single write by the drain thread
+_DRAIN_BATCH_SIZE = 256
+
+# Batched file handlers that are not closed yet, whose drain threads must be
+# restarted in forked processes
+_BATCHED_WRITERS: "weakref.WeakSet[BatchedFileWriter]" = weakref.WeakSet()
+
+# Batched file handlers whose drain locks are held during a `fork()`
+_FORKING_WRITERS: "List[BatchedFileWriter]" = []
+
+# Validators already built for a given log model and backend, so that repeated
+# calls to `setup_logging` reuse them
+_VALIDATOR_CACHE: Dict[Tuple[Type[BaseModel], str], Callable[[Any], Any]] = {}
+
+# Same for the filters built on top of those validators
+_FILTER_CACHE: Dict[Tuple[Type[BaseModel], str], Callable[[LogItem], bool]] = {}
+
 
 def customLogFormat(data: LogItem):
     """Formats a log to our liking.
@@ -22,39 +95,405 @@ def customLogFormat(data: LogItem):
     Returns:
         a string, which will be logged to the handler
     """
-    values = data.get("message")
-    process = data.get("process")
-    level = logging.getLevelName(data.get("level"))
-    return f"{process} - {level} - {values}\n"
+    get = data.get
+    level = get("level")
+    level_name = _LEVEL_NAMES.get(level) or logging.getLevelName(level)
+    return f"{get('process')} - {level_name} - {get('message')}\n"
+
+
+def buildLogFormat(fields: Sequence[str]) -> Callable[[LogItem], str]:
+    """Generates a formatter that outputs exactly the given log fields.
+
+    The formatter source is generated and compiled once, so each log only pays
+    for the lookups of its fields. As in `customLogFormat`, fields are
+    separated by " - " and the "level" field is output as the level name.
+
+    Arguments:
+        fields -- names of the log fields to output, in order
+
+    Returns:
+        a formatter, like `customLogFormat`
+    """
+    fields = tuple(fields)
+    log_format = _FORMAT_CACHE.get(fields)
+    if log_format is not None:
+        return log_format
+
+    lines = ["def log_format(data):", "    get = data.get"]
+    parts = []
+    for field in fields:
+        # Only identifiers, so that field names are safe to embed in the source
+        if not field.isidentifier():
+            raise ValueError(f"Invalid log field name: {field!r}")
+        if field == "level":
+            lines.append("    level = get('level')")
+            parts.append("{level_names.get(level) or get_level_name(level)}")
+        else:
+            parts.append(f"{{get('{field}')}}")
+    lines.append('    return f"' + " - ".join(parts) + '\\n"')
+    source = "\n".join(lines)
+    namespace = {
+        "level_names": _LEVEL_NAMES,
+        "get_level_name": logging.getLevelName,
+    }
+    exec(source, namespace)
+    log_format = _FORMAT_CACHE[fields] = namespace["log_format"]
+    return log_format
+
+
+def getLogModelStruct(
+    LogModel: Type[BaseModel], parents: Tuple[Type[BaseModel], ...] = ()
+) -> Type[Any]:
+    """Builds a `msgspec.Struct` with the same fields as a pydantic model.
+
+    Nested pydantic models are mirrored too, also inside other types (e.g.
+    `List[Model]` or `Optional[Model]`), and `extra = "forbid"` is mirrored by
+    forbidding unknown fields. The struct does not validate exactly like the
+    model, even in msgspec's lax mode:
+        - custom pydantic validators are not run.
+        - values are coerced differently: numbers are not valid strings,
+          floats with a fractional part and booleans are not valid ints, and
+          only true/false, 0/1 and "true"/"false" are valid bools. On the other
+          hand, numeric strings like "1.0" are valid ints.
+
+    Models that can't be mirrored raise a `TypeError`: recursive models,
+    models populated by field name as well as by alias, models constraining
+    the length of strings in their config, and pydantic-specific types (e.g.
+    `constr`), the latter when the decoder is created.
+
+    Arguments:
+        LogModel -- the pydantic model to mirror
+        parents -- the models whose fields contain `LogModel`, if nested
+
+    Returns:
+        a `msgspec.Struct` class
+    """
+    if LogModel in parents:
+        raise TypeError(f"Recursive models are not supported: {LogModel.__name__}")
+    model_config = LogModel.__config__
+    if model_config.allow_population_by_field_name and any(
+        field.alias != name for name, field in LogModel.__fields__.items()
+    ):
+        raise TypeError(
+            "Models populated by field name and alias are not supported: "
+            f"{LogModel.__name__}"
+        )
+    if model_config.min_anystr_length or model_config.max_anystr_length is not None:
+        raise TypeError(f"String length limits are not supported: {LogModel.__name__}")
+
+    parents += (LogModel,)
+    fields = []
+    for name, field in LogModel.__fields__.items():
+        annotation = mirrorAnnotation(field.annotation, parents)
+        if field.required:
+            fields.append((name, annotation, msgspec.field(name=field.alias)))
+        else:
+            default = msgspec.field(name=field.alias, default=None)
+            fields.append((name, annotation, default))
+    return msgspec.defstruct(
+        LogModel.__name__,
+        fields,
+        kw_only=True,
+        forbid_unknown_fields=model_config.extra == Extra.forbid,
+    )
+
+
+def mirrorAnnotation(
+    annotation: Any, parents: Tuple[Type[BaseModel], ...] = ()
+) -> Any:
+    """Replaces the pydantic models in a type annotation by `msgspec.Struct`s.
+
+    Arguments:
+        annotation -- the type annotation of a pydantic field
+        parents -- the models whose fields contain `annotation`
+
+    Returns:
+        the same annotation, with every pydantic model mirrored with
+        `getLogModelStruct`
+    """
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return getLogModelStruct(annotation, parents)
+    # Forward references are only needed by recursive models
+    if isinstance(annotation, (ForwardRef, str)):
+        raise TypeError(f"Forward references are not supported: {annotation}")
+    args = get_args(annotation)
+    if not args or get_origin(annotation) is Literal:
+        return annotation
+    mirrored_args = tuple(mirrorAnnotation(arg, parents) for arg in args)
+    if mirrored_args == args:
+        return annotation
+    # `typing` generics (e.g. `List[Model]`) vs builtin ones (e.g. `list[Model]`)
+    if hasattr(annotation, "copy_with"):
+        return annotation.copy_with(mirrored_args)
+    return get_origin(annotation)[mirrored_args]
+
+
+def getLogModelSchema(LogModel: Type[BaseModel]) -> Dict[str, Any]:
+    """Returns the JSON schema of a pydantic model, allowing nulls like pydantic.
+
+    Pydantic v1 schemas drop the nullability of fields: an `Optional[str]`
+    field is just a string. Here every field that accepts `None`, including
+    those of nested models, also accepts a JSON `null`.
+
+    Arguments:
+        LogModel -- the pydantic model to get the schema from
 
+    Returns:
+        the JSON schema of `LogModel`
+    """
+    schema = LogModel.schema()
+    definitions = schema.get("definitions", {})
+    models = get_flat_models_from_model(LogModel)
+    model_names = get_model_name_map(models)
+    for model in models:
+        if model is LogModel:
+            model_schema = schema
+        else:
+            model_schema = definitions.get(model_names[model])
+        if model_schema is None:
+            continue
+        properties = model_schema.get("properties", {})
+        for field in model.__fields__.values():
+            if field.allow_none and field.alias in properties:
+                nullable = {"anyOf": [properties[field.alias], {"type": "null"}]}
+                properties[field.alias] = nullable
+    return schema
+
+
+def getLogModelValidator(
+    LogModel: Type[BaseModel], backend: str = "pydantic"
+) -> Callable[[Any], Any]:
+    """Returns the validator of a log model, building it only once per model.
+
+    Unlike `pydantic.validate_model`, the returned validator raises one of
+    `VALIDATION_ERRORS` when the JSON message does not conform to the model.
+
+    Available backends:
+        - pydantic: parses the message and validates it with the model.
+        - fastjsonschema: parses the message and validates it with the JSON
+          schema of the model, compiled to a plain python function.
+        - msgspec: parses and validates the message in a single pass with a
+          `msgspec.Struct` mirroring the model.
+
+    The last two are much faster than pydantic, but do not run custom pydantic
+    validators. JSON schema validation is also stricter: values are not
+    coerced (e.g. "1" is not a valid int). msgspec coerces values, but not
+    like pydantic, and does not support every model: see `getLogModelStruct`.
 
-def performanceLogFilter(LogModel: BaseModel) -> Callable[[LogItem], bool]:
+    Arguments:
+        LogModel -- the pydantic model to validate logs against
+        backend -- the library used to validate logs (default: {"pydantic"})
+
+    Returns:
+        a function that validates a JSON message against `LogModel`
+    """
+    key = (LogModel, backend)
+    validator = _VALIDATOR_CACHE.get(key)
+    if validator is not None:
+        return validator
+
+    if backend == "msgspec":
+        if msgspec is None:
+            raise ImportError("msgspec backend requires msgspec")
+        struct = getLogModelStruct(LogModel)
+        validator = msgspec.json.Decoder(struct, strict=False).decode
+    else:
+        if backend == "pydantic":
+            validate_dict = LogModel.validate
+        elif backend == "fastjsonschema":
+            if fastjsonschema is None:
+                raise ImportError("fastjsonschema backend requires fastjsonschema")
+            validate_dict = fastjsonschema.compile(getLogModelSchema(LogModel))
+        else:
+            raise ValueError(f"Unknown validation backend: {backend}")
+        loads = _json.loads
+
+        def validator(message: Any) -> Any:
+            return validate_dict(loads(message))
+
+    _VALIDATOR_CACHE[key] = validator
+    return validator
+
+
+def performanceLogFilter(
+    LogModel: BaseModel, backend: str = "pydantic"
+) -> Callable[[LogItem], bool]:
     """Checks wether a log message conforms to the PerformanceMetrics class
 
     Arguments:
         record -- a log message
 
+    Keyword Arguments:
+        backend -- see `getLogModelValidator` (default: {"pydantic"})
+
     Returns:
         a boolean value
     """
 
+    key = (LogModel, backend)
+    cached_filter = _FILTER_CACHE.get(key)
+    if cached_filter is not None:
+        return cached_filter
+
+    validate = getLogModelValidator(LogModel, backend=backend)
+
+    # Keys that every conforming message must contain. If the model can be
+    # populated by field name as well as by alias, we can't tell which one
+    # will be used, so those fields are not checked. Neither are keys that
+    # JSON encoders may escape (e.g. non-ASCII characters or quotes)
+    by_field_name = LogModel.__config__.allow_population_by_field_name
+    str_needles = tuple(
+        f'"{field.alias}"'
+        for field in LogModel.__fields__.values()
+        if field.required
+        and not (by_field_name and field.alias != field.name)
+        and json.dumps(field.alias) == f'"{field.alias}"'
+    )
+    bytes_needles = tuple(needle.encode("utf-8") for needle in str_needles)
+
+    # Bind everything used per record to the closure, as polog does not accept
+    # filters with default arguments
+    is_instance = isinstance
+    json_object_starts = ("{", b"{")
+    errors = VALIDATION_ERRORS
+
     def inner_filter(record: LogItem) -> bool:
+        message = record.get("message")
+        # Most logs are not JSON objects, or lack some required key. Reject
+        # them with cheap checks before trying to parse
+        if is_instance(message, str):
+            needles = str_needles
+        elif is_instance(message, bytes):
+            needles = bytes_needles
+        else:
+            return False
+        if message[:1] not in json_object_starts:
+            return False
+        for needle in needles:
+            if needle not in message:
+                return False
         try:
-            raw_log = json.loads(dict(record).get("message"))
-            validate_model(LogModel, raw_log)
+            validate(message)
             return True
-        except (ValueError, ValidationError, Exception):
+        except errors:
             return False
 
+    _FILTER_CACHE[key] = inner_filter
     return inner_filter
 
 
+class BatchedFileWriter(file_writer):
+    """File handler that hands formatted logs off to a single drain thread.
+
+    Logging threads only append the formatted log to a deque, which is atomic
+    and takes no lock. Every `flush_interval` seconds, and at exit, the drain
+    thread joins the pending logs into batches, writes each batch at once and
+    flushes the file. This bounds the time a log can take to reach the disk.
+    Forked processes get their own drain thread.
+
+    The file is expected to be opened in binary mode: each batch is encoded
+    to UTF-8 once, instead of going through a text wrapper.
+    """
+
+    def __init__(self, *file, flush_interval: float, **kwargs):
+        super().__init__(*file, forced_flush=False, **kwargs)
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        # Only one thread at a time may pop pending logs and write them
+        self.drain_lock = threading.Lock()
+        self.start_drain_thread()
+        atexit.register(self.drain)
+        _BATCHED_WRITERS.add(self)
+
+    def start_drain_thread(self) -> None:
+        self.stopped = threading.Event()
+        self.drain_thread = threading.Thread(target=self.drain_forever, daemon=True)
+        self.drain_thread.start()
+
+    def do(self, content: str) -> None:
+        self.pending.append(content)
+
+    def drain(self) -> None:
+        """Writes all the pending logs to the file and flushes it."""
+        pending = self.pending
+        pop = pending.popleft
+        with self.drain_lock:
+            if not pending:
+                return
+            while pending:
+                size = min(len(pending), _DRAIN_BATCH_SIZE)
+                batch = [pop() for _ in range(size)]
+                self.maybe_rotation()
+                self.file.write("".join(batch).encode("utf-8"))
+            self.file.flush()
+
+    def drain_forever(self) -> None:
+        while not self.stopped.wait(self.flush_interval):
+            # A failed write must not stop the drain thread, or no other log
+            # would ever reach the file
+            try:
+                self.drain()
+            except Exception:
+                pass
+
+    def after_fork_in_child(self) -> None:
+        """Restarts the drain thread, which does not survive a `fork()`.
+
+        The logs pending at the time of the fork belong to the parent, which
+        writes them, so they are dropped here.
+        """
+        self.pending = deque()
+        self.drain_lock = threading.Lock()
+        if not self.stopped.is_set():
+            self.start_drain_thread()
+
+    def close(self) -> None:
+        """Stops the drain thread, writes the pending logs and closes the file."""
+        _BATCHED_WRITERS.discard(self)
+        self.stopped.set()
+        atexit.unregister(self.drain)
+        self.drain()
+        with self.drain_lock:
+            self.file.close()
+
+
+def _beforeFork() -> None:
+    # Hold every drain lock while forking, so that no batch is half written
+    # to the file buffer that the child inherits
+    writers = list(_BATCHED_WRITERS)
+    for writer in writers:
+        writer.drain_lock.acquire()
+    _FORKING_WRITERS[:] = writers
+
+
+def _afterForkInParent() -> None:
+    for writer in _FORKING_WRITERS:
+        writer.drain_lock.release()
+    _FORKING_WRITERS.clear()
+
+
+def _afterForkInChild() -> None:
+    for writer in _FORKING_WRITERS:
+        writer.after_fork_in_child()
+    _FORKING_WRITERS.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=_beforeFork,
+        after_in_parent=_afterForkInParent,
+        after_in_child=_afterForkInChild,
+    )
+
+
 def setup_logging(
     logfile: str = None,
     pool_size: int = 0,
     custom_log_format: Callable[[LogItem], str] = customLogFormat,
     custom_log_model: BaseModel = None,
     custom_log_filter: Callable[[LogItem], bool] = None,
+    flush_interval: float = 0.2,
+    log_fields: Sequence[str] = None,
 ) -> None:
     """Sets up logging using the polog module on top of stdlib logging.
 
@@ -84,43 +523,87 @@ def setup_logging(
     logging.info(
         json.dumps(
             {
-                "field1": "Custom log",
-                "field2": "Will appear both in file and in console",
+                "field1": "Will appear both in file and in console",
+                "field2": 1,
             }
         )
     )
     ```
 
     Keyword Arguments:
-        logfile -- If passed, location of desired file handler (default: {None}).
+        logfile -- If passed along with custom_log_model or custom_log_filter, location of desired file handler (default: {None}).
         pool_size -- Size of thread pool. 0 means sync logging (default: {0})
         custom_log_format -- Custom format for file logs (default: {customLogFormat})
         custom_log_model -- BaseModel to filter logs by (default: {None})
         custom_log_filter -- If passed, will use this filter and ignore custom_log_model (default: {None})
+        flush_interval -- Seconds between batched writes of the file handler. 0 means write on every log (default: {0.2})
+        log_fields -- If passed, logs will be formatted with these fields and custom_log_format is ignored (default: {None})
     """
+    # Setting up logging again with the same arguments is a no-op
+    global _CURRENT_SETUP
+    setup = (
+        logfile,
+        pool_size,
+        custom_log_format,
+        custom_log_model,
+        custom_log_filter,
+        flush_interval,
+        None if log_fields is None else tuple(log_fields),
+    )
+    if setup == _CURRENT_SETUP:
+        return
+
+    # Generate a formatter specialized for the requested fields
+    if log_fields is not None:
+        custom_log_format = buildLogFormat(log_fields)
+
     # Set basic config for logging module
     logging.basicConfig(level=logging.INFO)
 
     # stdout handler. Can log to a file instead if we modify the file writer
-    config.add_handlers(file_writer(formatter=custom_log_format))
-
-    # If no explicit filter is passed, we filter logs by `custom_log_model`
-    if not custom_log_filter:
-        custom_log_filter = performanceLogFilter(LogModel=custom_log_model)
-
-    # file handler. We add here the filter to only save performance metrics
-    if logfile:
-        config.add_handlers(
-            file_writer(
+    new_handlers = {_CONSOLE_HANDLER_NAME: file_writer(formatter=custom_log_format)}
+
+    # file handler. We add here the filter to only save performance metrics.
+    # Without a model nor a filter no log would get to the file, so we skip it
+    if logfile and (custom_log_filter or custom_log_model is not None):
+        # If no explicit filter is passed, we filter logs by `custom_log_model`
+        if not custom_log_filter:
+            custom_log_filter = performanceLogFilter(LogModel=custom_log_model)
+
+        # Batch the file writes unless we have to flush on every log
+        if flush_interval > 0:
+            file_handler = BatchedFileWriter(
+                open(logfile, "ab", buffering=_FILE_BUFFER_SIZE),
+                filter=custom_log_filter,
+                formatter=custom_log_format,
+                flush_interval=flush_interval,
+            )
+        else:
+            file_handler = file_writer(
                 logfile,
                 filter=custom_log_filter,
                 formatter=custom_log_format,
             )
-        )
+        new_handlers[_FILE_HANDLER_NAME] = file_handler
+
+    # Only once the new handlers are built, remove the handlers of the previous
+    # setup so that logs are not written more than once, and a bad setup keeps
+    # the previous one. Batched handlers are closed, which writes their pending
+    # logs before the ones of the new setup
+    handlers = config.get_handlers()
+    for name in (_CONSOLE_HANDLER_NAME, _FILE_HANDLER_NAME):
+        if name in handlers:
+            handler = handlers[name]
+            config.delete_handlers(name)
+            if isinstance(handler, BatchedFileWriter):
+                handler.close()
+    config.add_handlers(**new_handlers)
 
     # initialize the thread pool if needed
     config.set(pool_size=pool_size)
 
+    _CURRENT_SETUP = setup
+
 
 if __name__ == "__main__":
     TEST_LOG_FILE = "testing.log"
@@ -138,8 +621,8 @@ if __name__ == "__main__":
     logging.info(
         json.dumps(
             {
-                "field1": "Custom log",
-                "field2": "Will appear both in file and in console",
+                "field1": "Will appear both in file and in console",
+                "field2": 1,
             }
         )
     )
@@ -0,0 +1,373 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from typing import List, Optional
+
+import pytest
+
+from polog import config
+
+from polog_logger import polog_setup
+from pydantic import BaseModel, Extra, Field
+
+from polog_logger.polog_setup import (
+    VALIDATION_ERRORS,
+    BatchedFileWriter,
+    buildLogFormat,
+    getLogModelValidator,
+    performanceLogFilter,
+    setup_logging,
+)
+
+
+class SetupMetric(BaseModel):
+    name: str
+
+
+class FlatMetric(BaseModel):
+    name: str
+    value: int
+
+
+class AliasedMetric(BaseModel):
+    name: str = Field(..., alias="metricName")
+
+
+class OptionalMetric(BaseModel):
+    name: str
+    unit: Optional[str] = None
+
+
+class SubMetric(BaseModel):
+    value: int
+
+
+class NestedMetric(BaseModel):
+    sub: SubMetric
+    subs: List[SubMetric] = []
+    maybe_sub: Optional[SubMetric] = None
+
+
+class FlagMetric(BaseModel):
+    flag: bool
+
+
+class ForbidExtraMetric(BaseModel):
+    name: str
+
+    class Config:
+        extra = Extra.forbid
+
+
+class PopulatedByNameMetric(BaseModel):
+    name: str = Field(..., alias="metricName")
+    value: int
+
+    class Config:
+        allow_population_by_field_name = True
+
+
+class LimitedLengthMetric(BaseModel):
+    name: str
+
+    class Config:
+        max_anystr_length = 8
+
+
+class RecursiveMetric(BaseModel):
+    children: List["RecursiveMetric"] = []
+
+
+RecursiveMetric.update_forward_refs()
+
+
+BACKEND_CASES = [
+    (FlatMetric, '{"name": "a", "value": 1}'),
+    (FlatMetric, '{"name": "a", "value": "1"}'),
+    (FlatMetric, '{"name": "a", "value": "x"}'),
+    (FlatMetric, '{"name": "a"}'),
+    (AliasedMetric, '{"metricName": "a"}'),
+    (AliasedMetric, '{"name": "a"}'),
+    (OptionalMetric, '{"name": "a"}'),
+    (OptionalMetric, '{"name": "a", "unit": null}'),
+    (OptionalMetric, '{"name": "a", "unit": "ms"}'),
+    (NestedMetric, '{"sub": {"value": 1}}'),
+    (NestedMetric, '{"sub": {"value": 1}, "subs": [{"value": 2}]}'),
+    (NestedMetric, '{"sub": {"value": 1}, "maybe_sub": {"value": 2}}'),
+    (NestedMetric, '{"sub": {"value": 1}, "maybe_sub": null}'),
+    (NestedMetric, '{"sub": {"other": 1}}'),
+    (NestedMetric, '{"sub": {"value": 1}, "subs": [{"value": "x"}]}'),
+    (FlagMetric, '{"flag": "true"}'),
+    (FlagMetric, '{"flag": 1}'),
+    (ForbidExtraMetric, '{"name": "a"}'),
+    (ForbidExtraMetric, '{"name": "a", "other": 1}'),
+]
+
+
+def isValid(LogModel, backend, message) -> bool:
+    try:
+        getLogModelValidator(LogModel, backend=backend)(message)
+        return True
+    except VALIDATION_ERRORS:
+        return False
+
+
+@pytest.mark.parametrize("LogModel, message", BACKEND_CASES)
+def test_msgspec_backend_agrees_with_pydantic(LogModel, message):
+    pytest.importorskip("msgspec")
+    assert isValid(LogModel, "msgspec", message) == isValid(
+        LogModel, "pydantic", message
+    )
+
+
+@pytest.mark.parametrize(
+    "LogModel, message, valid_in_pydantic",
+    [
+        (FlatMetric, '{"name": 1, "value": 1}', True),
+        (FlatMetric, '{"name": "a", "value": 1.5}', True),
+        (FlatMetric, '{"name": "a", "value": true}', True),
+        (FlatMetric, '{"name": "a", "value": "1.0"}', False),
+        (FlagMetric, '{"flag": "yes"}', True),
+    ],
+)
+def test_msgspec_backend_coerces_unlike_pydantic(LogModel, message, valid_in_pydantic):
+    pytest.importorskip("msgspec")
+    assert isValid(LogModel, "pydantic", message) == valid_in_pydantic
+    assert isValid(LogModel, "msgspec", message) != valid_in_pydantic
+
+
+@pytest.mark.parametrize(
+    "LogModel", [PopulatedByNameMetric, LimitedLengthMetric, RecursiveMetric]
+)
+def test_msgspec_backend_rejects_unsupported_models(LogModel):
+    pytest.importorskip("msgspec")
+    with pytest.raises(TypeError):
+        getLogModelValidator(LogModel, backend="msgspec")
+
+
+def test_batched_file_writer_concurrent_drain(tmp_path):
+    logfile = tmp_path / "batched.log"
+    handler = BatchedFileWriter(open(logfile, "ab"), flush_interval=0.0001)
+    expected = [f"{thread} {i}\n" for thread in range(4) for i in range(20000)]
+    errors = []
+
+    def produce(thread: int) -> None:
+        for i in range(20000):
+            handler.do(f"{thread} {i}\n")
+
+    def drain_while(threads) -> None:
+        try:
+            while any(thread.is_alive() for thread in threads):
+                handler.drain()
+        except Exception as e:
+            errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        producers = [threading.Thread(target=produce, args=(t,)) for t in range(4)]
+        drainers = [
+            threading.Thread(target=drain_while, args=(producers,)) for _ in range(2)
+        ]
+        for thread in producers + drainers:
+            thread.start()
+        for thread in producers + drainers:
+            thread.join()
+        handler.close()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert not errors
+    lines = logfile.read_text().splitlines(keepends=True)
+    assert Counter(lines) == Counter(expected)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork()")
+def test_batched_file_writer_drains_in_forked_child(tmp_path):
+    logfile = tmp_path / "forked.log"
+    handler = BatchedFileWriter(open(logfile, "ab"), flush_interval=0.01)
+    handler.do("parent\n")
+
+    pid = os.fork()
+    if pid == 0:
+        # Child: log, let the drain thread write, and exit without atexit
+        try:
+            for _ in range(10):
+                handler.do("child\n")
+            time.sleep(0.5)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    handler.close()
+
+    lines = logfile.read_text().splitlines(keepends=True)
+    assert Counter(lines) == Counter({"parent\n": 1, "child\n": 10})
+
+
+@pytest.fixture
+def polog_handlers():
+    """Removes the handlers registered by `setup_logging` after the test."""
+    yield
+    handlers = config.get_handlers()
+    for name in ("polog_logger_console", "polog_logger_file"):
+        if name in handlers:
+            handler = handlers[name]
+            config.delete_handlers(name)
+            if isinstance(handler, BatchedFileWriter):
+                handler.close()
+    polog_setup._CURRENT_SETUP = None
+
+
+def test_setup_logging_replaces_file_handler(tmp_path, polog_handlers):
+    first_logfile = tmp_path / "first.log"
+    second_logfile = tmp_path / "second.log"
+
+    setup_logging(logfile=str(first_logfile), custom_log_model=SetupMetric)
+    first_handler = config.get_handlers()["polog_logger_file"]
+    logging.warning(json.dumps({"name": "first"}))
+
+    setup_logging(logfile=str(second_logfile), custom_log_model=SetupMetric)
+    second_handler = config.get_handlers()["polog_logger_file"]
+    logging.warning(json.dumps({"name": "second"}))
+    second_handler.drain()
+
+    first_handler.drain_thread.join(timeout=1)
+    assert not first_handler.drain_thread.is_alive()
+    assert first_handler.file.file.closed
+    assert first_logfile.read_text().splitlines() == [
+        'MainProcess (%d) - WARNING - {"name": "first"}' % os.getpid()
+    ]
+    assert second_logfile.read_text().splitlines() == [
+        'MainProcess (%d) - WARNING - {"name": "second"}' % os.getpid()
+    ]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"log_fields": ["level", "bad-field"]}, {"custom_log_model": object()}],
+)
+def test_setup_logging_keeps_previous_setup_on_error(tmp_path, polog_handlers, kwargs):
+    logfile = tmp_path / "kept.log"
+    setup_logging(logfile=str(logfile), custom_log_model=SetupMetric)
+    names = ("polog_logger_console", "polog_logger_file")
+    handlers = [config.get_handlers()[name] for name in names]
+
+    with pytest.raises(Exception):
+        setup_logging(logfile=str(tmp_path / "bad.log"), **kwargs)
+
+    assert [config.get_handlers()[name] for name in names] == handlers
+    logging.warning(json.dumps({"name": "kept"}))
+    handlers[1].drain()
+    assert logfile.read_text().splitlines() == [
+        'MainProcess (%d) - WARNING - {"name": "kept"}' % os.getpid()
+    ]
+
+
+def test_build_log_format_field_order():
+    log_format = buildLogFormat(["message", "process"])
+    assert log_format({"process": "Main", "message": "hi"}) == "hi - Main\n"
+
+
+def test_build_log_format_level_names():
+    log_format = buildLogFormat(["level", "message"])
+    assert log_format({"level": logging.WARNING, "message": "hi"}) == (
+        "WARNING - hi\n"
+    )
+    assert log_format({"level": 25, "message": "hi"}) == "Level 25 - hi\n"
+
+
+def test_build_log_format_rejects_invalid_field_names():
+    with pytest.raises(ValueError):
+        buildLogFormat(["message", "x') or exit('"])
+
+
+def test_build_log_format_is_cached():
+    assert buildLogFormat(["process", "message"]) is buildLogFormat(
+        ("process", "message")
+    )
+
+
+@pytest.mark.parametrize(
+    "LogModel, message",
+    [
+        (OptionalMetric, '{"name": "a"}'),
+        (OptionalMetric, '{"name": "a", "unit": null}'),
+        (OptionalMetric, '{"name": "a", "unit": "ms"}'),
+        (OptionalMetric, '{"name": null}'),
+        (NestedMetric, '{"sub": {"value": 1}, "maybe_sub": null}'),
+        (NestedMetric, '{"sub": {"value": 1}, "maybe_sub": {"value": null}}'),
+    ],
+)
+def test_fastjsonschema_backend_allows_nulls_like_pydantic(LogModel, message):
+    pytest.importorskip("fastjsonschema")
+    assert isValid(LogModel, "fastjsonschema", message) == isValid(
+        LogModel, "pydantic", message
+    )
+
+
+class EscapedKeyMetric(BaseModel):
+    temperature: float = Field(..., alias="température")
+    quoted: str = Field(..., alias='say "hi"')
+
+
+@pytest.mark.parametrize(
+    "LogModel, message",
+    [
+        (FlatMetric, '{"name": "a", "value": 1}'),
+        (FlatMetric, b'{"name": "a", "value": 1}'),
+        (
+            EscapedKeyMetric,
+            json.dumps({"température": 1.5, 'say "hi"': "hi"}),
+        ),
+        (
+            EscapedKeyMetric,
+            json.dumps({"température": 1.5, 'say "hi"': "hi"}, ensure_ascii=False),
+        ),
+        (AliasedMetric, '{"metricName": "a"}'),
+        (AliasedMetric, b'{"metricName": "a"}'),
+        (OptionalMetric, '{"name": "a"}'),
+        (PopulatedByNameMetric, '{"metricName": "a", "value": 1}'),
+        (PopulatedByNameMetric, '{"name": "a", "value": 1}'),
+        (PopulatedByNameMetric, b'{"name": "a", "value": 1}'),
+    ],
+)
+def test_filter_accepts_conforming_messages(LogModel, message):
+    assert performanceLogFilter(LogModel)({"message": message})
+
+
+def test_filter_rejects_non_conforming_messages():
+    log_filter = performanceLogFilter(FlatMetric)
+    assert log_filter({"message": '{"name": "a", "value": 1}'})
+    assert not log_filter({"message": '{"name": "a", "value": "x"}'})
+
+
+def test_filter_rejects_with_msgspec_backend():
+    pytest.importorskip("msgspec")
+    log_filter = performanceLogFilter(FlatMetric, backend="msgspec")
+    assert log_filter({"message": '{"name": "a", "value": 1}'})
+    assert not log_filter({"message": '{"name": "a", "value": "x"}'})
+
+
+def test_filter_rejects_missing_keys_before_parsing(monkeypatch):
+    class PrefilteredMetric(BaseModel):
+        name: str
+        value: int
+
+    validated = []
+    monkeypatch.setattr(
+        polog_setup, "getLogModelValidator", lambda *args, **kwargs: validated.append
+    )
+    log_filter = performanceLogFilter(PrefilteredMetric)
+
+    assert not log_filter({"message": '{"name": "a"}'})
+    assert not log_filter({"message": b'{"name": "a"}'})
+    assert not log_filter({"message": "not json"})
+    assert not validated
+
+    assert log_filter({"message": '{"name": "a", "value": 1}'})
+    assert validated == ['{"name": "a", "value": 1}']